@@ -2,40 +2,127 @@ import pandas as pd
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xlsxwriter
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, find_closest falls back to numpy without it
+    njit = None
 
-def find_closest(row, df):
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:  # pyarrow is optional, read_csv falls back to the pandas C parser without it
+    CSV_ENGINE = 'c'
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:  # python-calamine is optional, xlsx files are streamed through openpyxl without it
+    EXCEL_ENGINE = None
+
+KESTREL_TIMESTAMP_FORMAT = '%Y-%m-%d %I:%M:%S %p'
+GARMIN_TIMESTAMP_FORMAT = '%H:%M:%S'
+
+
+def time_of_day(timestamps):
     """
-    Find the closest timestamp in kestrel_df to the timestamp in the current row of garmin_df.
+    Return the nanoseconds since midnight of each timestamp, so Garmin times and dated Kestrel readings can be compared.
     """
-    try:
-        row_time = pd.to_datetime(row['Timestamp'], format='%H:%M:%S')
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format='%H:%M:%S')
-        time_diff = (df['Timestamp'] - row_time).abs()
-        closest_index = time_diff.idxmin()
-        return df.loc[closest_index]
-    except Exception as e:
-        print(f"Error in find_closest: {e}")
-        raise
+    return (timestamps - timestamps.dt.normalize()).to_numpy(dtype='timedelta64[ns]').view('i8')
 
 
-def process_garmin_sheet(sheet_name, garmin_df, kestrel_df):
+def closest_kernel(garmin_times, kestrel_times):
     """
-    Process each Garmin sheet by renaming columns, formatting timestamps, and finding the closest matches in Kestrel data.
+    Walk the sorted Garmin and Kestrel times together, keeping the earlier time on ties and the first of repeated times.
+    """
+    closest = np.empty(len(garmin_times), dtype=np.int64)
+    last = len(kestrel_times) - 1
+    j = 0
+    run_start = 0  # first position holding the same time as kestrel_times[j]
+    for i in range(len(garmin_times)):
+        time = garmin_times[i]
+        while j < last and kestrel_times[j + 1] < time:
+            j += 1
+            if kestrel_times[j] != kestrel_times[j - 1]:
+                run_start = j
+        if j < last and kestrel_times[j + 1] - time < time - kestrel_times[j]:
+            closest[i] = j + 1
+        else:
+            closest[i] = run_start
+    return closest
+
+
+closest_kernel_jit = njit(cache=True)(closest_kernel) if njit is not None else None
+
+
+def find_closest(garmin_times, kestrel_times):
+    """
+    Find the position of the closest sorted Kestrel time for each Garmin time.
+    Equally close times resolve to the earlier time, and repeated times to their first position.
+    """
+    if closest_kernel_jit is not None:
+        garmin_order = np.argsort(garmin_times, kind='stable')
+        closest = np.empty(len(garmin_times), dtype=np.int64)
+        closest[garmin_order] = closest_kernel_jit(garmin_times[garmin_order], kestrel_times)
+        return closest
+    if len(kestrel_times) < 2:
+        return np.zeros(len(garmin_times), dtype=np.intp)
+    after = np.searchsorted(kestrel_times, garmin_times).clip(1, len(kestrel_times) - 1)
+    before = after - 1
+    closest = np.where(garmin_times - kestrel_times[before] <= kestrel_times[after] - garmin_times, before, after)
+    # Readings from different days can share a time of day; take the first of them, as it comes first in the file
+    return np.searchsorted(kestrel_times, kestrel_times[closest], 'left')
+
+
+def sort_kestrel(kestrel_df):
+    """
+    Sort the time of day of the Kestrel readings that have a timestamp, returning the int64 times and their row positions.
+    """
+    timestamps = kestrel_df['Timestamp']
+    positions = np.flatnonzero(timestamps.notna().to_numpy())
+    kestrel_times = time_of_day(timestamps.iloc[positions])
+    kestrel_order = np.argsort(kestrel_times, kind='stable')
+    return kestrel_times[kestrel_order], positions[kestrel_order]
+
+
+def process_garmin_sheet(sheet_name, garmin_df, kestrel_times, kestrel_positions):
+    """
+    Process each Garmin sheet by renaming columns, dropping rows without a timestamp, and finding the closest matches in Kestrel data.
+    Only the Kestrel times take part in matching; the sheet is returned with the Kestrel row position matched to each shot.
     """
     try:
         print(f"Processing Garmin sheet: {sheet_name}")
-        garmin_df.rename(columns={garmin_df.columns[5]: 'Timestamp'}, inplace=True)
-        garmin_df['Timestamp'] = pd.to_datetime(garmin_df['Timestamp'], format='%H:%M:%S', errors='coerce').dt.strftime('%H:%M:%S')
-        garmin_df.dropna(subset=['Timestamp'], inplace=True)
-        closest_rows = garmin_df.apply(lambda row: find_closest(row, kestrel_df), axis=1)
-        combined_df = pd.concat([garmin_df.reset_index(drop=True), closest_rows.reset_index(drop=True)], axis=1)
-        return combined_df
+        garmin_df = garmin_df.rename(columns={garmin_df.columns[5]: 'Timestamp'}).dropna(subset=['Timestamp'])
+        closest = kestrel_positions[find_closest(time_of_day(garmin_df['Timestamp']), kestrel_times)]
+        return garmin_df, closest
     except Exception as e:
         print(f"Error in process_garmin_sheet: {e}")
         raise
 
 
+def combine_sheet(garmin_df, closest, kestrel_df):
+    """
+    Combine a Garmin sheet with its matched Kestrel rows, gathering each Kestrel column with one fancy-index.
+    """
+    # The output headers are positional, so clashing column names only need to stay unique
+    closest_columns = {(column if column not in garmin_df.columns else f"{column} (Kestrel)"): kestrel_df[column].to_numpy()[closest]
+                       for column in kestrel_df.columns}
+    return garmin_df.reset_index(drop=True).assign(**closest_columns)
+
+
+def parse_timestamps(timestamps, time_format):
+    """
+    Return the timestamps as datetime64, coercing unparseable values to NaT if the reader left the column as text.
+    """
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps
+    return pd.to_datetime(timestamps, format=time_format, errors='coerce')
+
+
 def read_file(file_path, is_kestrel):
     """
     Read the Kestrel or Garmin file based on the file extension and is_kestrel flag.
@@ -52,22 +139,43 @@ def read_file(file_path, is_kestrel):
         raise
 
 
+def read_excel_sheets(file_path, skiprows, column_count, all_sheets=False):
+    """
+    Read the first sheet, or every sheet as a dict, using the row after skiprows as the header and keeping the first column_count columns.
+    """
+    sheet_name = None if all_sheets else 0
+    if EXCEL_ENGINE is not None or not file_path.endswith('.xlsx'):
+        return pd.read_excel(file_path, sheet_name=sheet_name, skiprows=skiprows, usecols=list(range(column_count)), engine=EXCEL_ENGINE)
+
+    # Without calamine, stream plain values from a read-only workbook instead of letting openpyxl build every cell
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for worksheet in workbook.worksheets if all_sheets else workbook.worksheets[:1]:
+            rows = (row for row in worksheet.iter_rows(min_row=skiprows + 1, max_col=column_count, values_only=True)
+                    if any(value is not None for value in row))
+            header = [f"Unnamed: {i}" if name is None else name for i, name in enumerate(next(rows, ()))]
+            sheets[worksheet.title] = pd.DataFrame.from_records(list(rows), columns=header)
+    finally:
+        workbook.close()
+    return sheets if all_sheets else next(iter(sheets.values()))
+
+
 def read_excel(file_path, is_kestrel):
     """
     Read Excel file for Kestrel or Garmin data.
     """
     if is_kestrel:
-        df = pd.read_excel(file_path, skiprows=5, usecols=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14])
-        df.rename(columns={df.columns[0]: 'Timestamp', df.columns[1]: 'Temperature',
-                           df.columns[2]: 'Relative Humidity', df.columns[3]: 'Station Pressure'}, inplace=True)
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format='%Y-%m-%d %I:%M:%S %p', errors='coerce').dt.strftime('%H:%M:%S')
+        df = read_excel_sheets(file_path, skiprows=5, column_count=15)
+        df = (df.rename(columns={df.columns[0]: 'Timestamp', df.columns[1]: 'Temperature',
+                                 df.columns[2]: 'Relative Humidity', df.columns[3]: 'Station Pressure'})
+              .assign(Timestamp=lambda d: parse_timestamps(d['Timestamp'], KESTREL_TIMESTAMP_FORMAT)))
     else:
-        xl = pd.ExcelFile(file_path)
-        df_dict = {sheet: xl.parse(sheet, skiprows=1, usecols=[0, 1, 2, 3, 4, 5, 6, 7, 8]) for sheet in xl.sheet_names}
-        for df in df_dict.values():
-            df.rename(columns={df.columns[5]: 'Timestamp'}, inplace=True)
-            df['Timestamp'] = pd.to_datetime(df['Timestamp'], format='%H:%M:%S', errors='coerce').dt.strftime('%H:%M:%S')
-        return df_dict
+        df_dict = read_excel_sheets(file_path, skiprows=1, column_count=9, all_sheets=True)
+        return {sheet: df.rename(columns={df.columns[5]: 'Timestamp'})
+                .assign(Timestamp=lambda d: parse_timestamps(d['Timestamp'], GARMIN_TIMESTAMP_FORMAT))
+                for sheet, df in df_dict.items()}
     return df
 
 
@@ -76,17 +184,28 @@ def read_csv(file_path, is_kestrel):
     Read CSV file for Kestrel or Garmin data.
     """
     if is_kestrel:
-        df = pd.read_csv(file_path, skiprows=5)
-        df.columns = [
+        columns = [
             'Timestamp', 'Temperature', 'Relative Humidity', 'Station Pressure',
             'Heat Index', 'Dew Point', 'Density Altitude', 'Data Type',
             'Record name', 'Start time', 'Duration (H:M:S)', 'Location description',
             'Location address', 'Location coordinates', 'Notes'
         ]
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format='%Y-%m-%d %I:%M:%S %p', errors='coerce').dt.strftime('%H:%M:%S')
+        # The pyarrow engine ignores skiprows when header=0 is combined with names, so skip the header row as well.
+        # Timestamp and the text columns are read as str: pyarrow would otherwise infer dates and times the C parser leaves
+        # as text, and it applies date_format to every column, so Timestamp is parsed afterwards by parse_timestamps.
+        read_options = dict(skiprows=6, header=None, names=columns, dtype=dict.fromkeys(columns[:1] + columns[7:], str))
+        try:
+            df = pd.read_csv(file_path, engine=CSV_ENGINE, **read_options)
+        except pd.errors.ParserError:
+            if CSV_ENGINE == 'c':
+                raise
+            # pyarrow rejects rows with missing trailing fields, which the C parser pads with NaN
+            df = pd.read_csv(file_path, engine='c', **read_options)
+        df['Timestamp'] = parse_timestamps(df['Timestamp'], KESTREL_TIMESTAMP_FORMAT)
     else:
-        df = pd.read_csv(file_path, skiprows=1, usecols=[0, 1, 2, 3, 4, 5, 6, 7, 8])
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format='%H:%M:%S', errors='coerce').dt.strftime('%H:%M:%S')
+        df = pd.read_csv(file_path, skiprows=1, usecols=[0, 1, 2, 3, 4, 5, 6, 7, 8],
+                         parse_dates=['Timestamp'], date_format=GARMIN_TIMESTAMP_FORMAT)
+        df['Timestamp'] = parse_timestamps(df['Timestamp'], GARMIN_TIMESTAMP_FORMAT)
     return df
 
 
@@ -95,49 +214,90 @@ def generate_unique_filename(filepath):
     Generate a unique filename by appending a counter if the file already exists.
     """
     base, extension = os.path.splitext(filepath)
+    directory = os.path.dirname(filepath) or '.'
+    with os.scandir(directory) as entries:
+        # Compare case-folded names so case-insensitive filesystems (Windows, default macOS) never get a file overwritten;
+        # on case-sensitive ones this at worst skips a free name
+        existing_names = {entry.name.casefold() for entry in entries}
     counter = 1
     new_filepath = filepath
-    while os.path.exists(new_filepath):
+    while os.path.basename(new_filepath).casefold() in existing_names:
         new_filepath = f"{base}_{counter}{extension}"
         counter += 1
     return new_filepath
 
 
-def process_files(kestrel_path, garmin_path):
+def write_combined_workbook(output_file, matched_sheets, kestrel_df):
+    """
+    Write each combined sheet straight to an xlsxwriter workbook, streaming rows to disk in order.
+    Sheets are combined with their Kestrel rows one at a time, so only one combined sheet is held in memory.
+    """
+    headers = ['Shot Count', 'Speed (MPS)', 'Δ AVG (MPS)', 'KE (J)', 'Power Factor (N⋅s)', 'Time',
+               'Clean Bore', 'Cold Bore', 'Shot Notes', 'Timestamp', 'Temperature', 'Relative Humidity',
+               'Station Pressure', 'Heat Index', 'Dew Point', 'Density Altitude', 'Data Type', 'Record name',
+               'Start time', 'Duration (H:M:S)', 'Location description', 'Location address', 'Location coordinates', 'Notes']
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'strings_to_urls': False,
+                                              'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    try:
+        for sheet_name, garmin_df, closest in matched_sheets:
+            combined_df = combine_sheet(garmin_df, closest, kestrel_df)
+            combined_df.columns = headers[:combined_df.shape[1]]  # Ensure only the number of columns present
+            for column in ('Time', 'Timestamp'):
+                combined_df[column] = combined_df[column].dt.strftime(GARMIN_TIMESTAMP_FORMAT)
+            # xlsxwriter rejects NaN, so missing values become None and are left as empty cells
+            combined_df = combined_df.astype(object).where(combined_df.notna(), None)
+
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(5, 0, combined_df.columns)
+            for row_number, row in enumerate(combined_df.itertuples(index=False, name=None), start=6):
+                worksheet.write_row(row_number, 0, row)
+    finally:
+        workbook.close()
+
+
+def show_message_now(show, title, message):
+    """
+    Show a message box straight away, for callers already on the Tk main thread.
+    """
+    show(title, message)
+
+
+def process_files(kestrel_path, garmin_path, show_message=show_message_now, on_finish=None):
     """
     Process the selected Kestrel and Garmin files, combine the data, and save it to a new file.
+    Results are reported through show_message(show, title, message), and on_finish is called once processing ends.
     """
     try:
-        print(f"Reading Kestrel file: {kestrel_path}")
-        kestrel_df = read_file(kestrel_path, is_kestrel=True)
+        # The two files are independent, so read them side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            print(f"Reading Kestrel file: {kestrel_path}")
+            kestrel_future = executor.submit(read_file, kestrel_path, is_kestrel=True)
+            print(f"Reading Garmin file: {garmin_path}")
+            garmin_future = executor.submit(read_file, garmin_path, is_kestrel=False)
+            kestrel_df = kestrel_future.result()
+            garmin_sheets = garmin_future.result()
         print(f"Kestrel DataFrame:\n{kestrel_df.head()}")
+        kestrel_times, kestrel_positions = sort_kestrel(kestrel_df)
 
-        print(f"Reading Garmin file: {garmin_path}")
-        garmin_sheets = read_file(garmin_path, is_kestrel=False)
-
-        all_combined_dfs = []
+        matched_sheets = []
         if isinstance(garmin_sheets, dict):
             for sheet_name, garmin_df in garmin_sheets.items():
-                combined_df = process_garmin_sheet(sheet_name, garmin_df, kestrel_df)
-                all_combined_dfs.append((sheet_name, combined_df))
+                garmin_df, closest = process_garmin_sheet(sheet_name, garmin_df, kestrel_times, kestrel_positions)
+                matched_sheets.append((sheet_name, garmin_df, closest))
         else:
-            combined_df = process_garmin_sheet("Sheet1", garmin_sheets, kestrel_df)
-            all_combined_dfs.append(("Sheet1", combined_df))
+            garmin_df, closest = process_garmin_sheet("Sheet1", garmin_sheets, kestrel_times, kestrel_positions)
+            matched_sheets.append(("Sheet1", garmin_df, closest))
 
         output_file = generate_unique_filename(os.path.join(os.path.dirname(kestrel_path), 'Combined_Output.xlsx'))
-        with pd.ExcelWriter(output_file) as writer:
-            for sheet_name, combined_df in all_combined_dfs:
-                headers = ['Shot Count', 'Speed (MPS)', 'Δ AVG (MPS)', 'KE (J)', 'Power Factor (N⋅s)', 'Time',
-                           'Clean Bore', 'Cold Bore', 'Shot Notes', 'Timestamp', 'Temperature', 'Relative Humidity',
-                           'Station Pressure', 'Heat Index', 'Dew Point', 'Density Altitude', 'Data Type', 'Record name',
-                           'Start time', 'Duration (H:M:S)', 'Location description', 'Location address', 'Location coordinates', 'Notes']
-                combined_df.columns = headers[:combined_df.shape[1]]  # Ensure only the number of columns present
-                combined_df.to_excel(writer, sheet_name=sheet_name, index=False, startrow=5)
-
-        messagebox.showinfo("Success", f"The combined data has been saved to {output_file}")
+        write_combined_workbook(output_file, matched_sheets, kestrel_df)
+
+        show_message(messagebox.showinfo, "Success", f"The combined data has been saved to {output_file}")
     except Exception as e:
-        messagebox.showerror("Error", f"An error occurred: {e}")
+        show_message(messagebox.showerror, "Error", f"An error occurred: {e}")
         print(f"Error in process_files: {e}")
+    finally:
+        if on_finish is not None:
+            on_finish()
 
 
 def select_file(entry_widget, is_kestrel):
@@ -168,7 +328,16 @@ def combine_files():
         messagebox.showwarning("Warning", "Selected files must be Excel or CSV files")
         return
 
-    process_files(kestrel_path, garmin_path)
+    def show_message(show, title, message):
+        # Tk widgets must only be touched from the main loop, so the worker schedules its message boxes there
+        root.after(0, show, title, message)
+
+    def on_finish():
+        root.after(0, lambda: combine_button.config(state=tk.NORMAL))
+
+    # Process in a worker thread so the window stays responsive; the button is re-enabled when it finishes
+    combine_button.config(state=tk.DISABLED)
+    threading.Thread(target=process_files, args=(kestrel_path, garmin_path, show_message, on_finish), daemon=True).start()
 
 
 if __name__ == "__main__":